@@ -3,6 +3,7 @@
 
 import httplib2
 import urllib
+import urlparse
 import time
 import traceback
 
@@ -15,7 +16,10 @@ def main():
 			login_method = dict(default = 'POST'),
 			login_data = dict(required = False),
 			login_retries = dict(default = 120),
-			login_interval = dict(default = 10)
+			login_interval = dict(default = 10),
+			connect_timeout = dict(default = 10),
+			read_timeout = dict(default = 60),
+			deadline = dict(required = False)
 		),
 		supports_check_mode = True
 	)
@@ -32,21 +36,42 @@ def main():
 	login_retries = params['login_retries']
 	login_interval = params['login_interval']
 
-	cookie = login(
-		module,
-		base_url + login_path,
-		login_method,
-		login_data,
-		login_retries,
-		login_interval
+	http = HttpClient(
+		timeout_value(params['connect_timeout']),
+		timeout_value(params['read_timeout']),
+		timeout_value(params['deadline'])
 	)
 
-	response, content = invoke_url(module, base_url + path, cookie)
+	try:
+		cookie = login(
+			module,
+			http,
+			base_url + login_path,
+			login_method,
+			login_data,
+			login_retries,
+			login_interval
+		)
+
+		response, content = invoke_url(module, http, base_url + path, cookie)
+	except DeadlineExceededException as e:
+		module.fail_json(
+			msg = str(e),
+			deadline_exceeded = True,
+			elapsed = http.elapsed(),
+			timings = http.timings
+		)
 
 	if response['status'] == '500':
-		module.fail_json(msg = content)
+		module.fail_json(msg = content, elapsed = http.elapsed(), timings = http.timings)
 	else:
-		module.exit_json(changed = response['status'] == '201', ok = True, msg = content)
+		module.exit_json(
+			changed = response['status'] == '201',
+			ok = True,
+			msg = content,
+			elapsed = http.elapsed(),
+			timings = http.timings
+		)
 
 class FailedLoginException(Exception):
 	def __init__(self, response):
@@ -54,13 +79,98 @@ class FailedLoginException(Exception):
 	def __str__(self):
 		return str(self.response)
 
-def login(module, url, login_method, login_data, login_retries, login_interval):
+class DeadlineExceededException(Exception):
+	def __init__(self, url, deadline, elapsed):
+		self.url = url
+		self.deadline = deadline
+		self.elapsed = elapsed
+	def __str__(self):
+		return 'Deadline of {0}s exceeded after {1:.3f}s: {2}'.format(self.deadline, self.elapsed, self.url)
+
+# todas as chamadas http de uma execucao do modulo passam por este cliente, que
+# aplica os timeouts de conexao e de leitura de cada requisicao e limita o tempo
+# total gasto pelo conjunto delas ao deadline configurado
+class HttpClient(object):
+	def __init__(self, connect_timeout, read_timeout, deadline):
+		self.connect_timeout = connect_timeout
+		self.read_timeout = read_timeout
+		self.deadline = deadline
+		self.started = time.time()
+		self.timings = []
+
+	def elapsed(self):
+		return time.time() - self.started
+
+	def remaining(self, url):
+		if self.deadline is None:
+			return None
+
+		remaining = self.deadline - self.elapsed()
+		if remaining <= 0:
+			raise DeadlineExceededException(url, self.deadline, self.elapsed())
+
+		return remaining
+
+	def bounded(self, timeout, url):
+		remaining = self.remaining(url)
+
+		if remaining is None:
+			return timeout
+		if timeout is None:
+			return remaining
+		return min(timeout, remaining)
+
+	def request(self, url, method, **kwargs):
+		connect_timeout = self.bounded(self.connect_timeout, url)
+		read_timeout = self.bounded(self.read_timeout, url)
+
+		h = httplib2.Http(timeout = connect_timeout)
+		timing = dict(url = url, method = method)
+		started = time.time()
+
+		try:
+			response, content = h.request(
+				url,
+				method,
+				connection_type = build_connection_type(url, read_timeout),
+				**kwargs
+			)
+			timing['status'] = response['status']
+			return response, content
+		except Exception as e:
+			timing['error'] = str(e)
+			# um timeout provocado pelo esgotamento do deadline e reportado como tal
+			self.remaining(url)
+			raise
+		finally:
+			timing['elapsed'] = time.time() - started
+			self.timings.append(timing)
+
+def build_connection_type(url, read_timeout):
+	if urlparse.urlparse(url).scheme == 'https':
+		base = httplib2.HTTPSConnectionWithTimeout
+	else:
+		base = httplib2.HTTPConnectionWithTimeout
+
+	# o httplib2 usa o mesmo timeout para conexao e leitura; apos conectar,
+	# o timeout do socket e trocado pelo timeout de leitura
+	class ReadTimeoutConnection(base):
+		def connect(self):
+			base.connect(self)
+			self.sock.settimeout(read_timeout)
+
+	return ReadTimeoutConnection
+
+def timeout_value(value):
+	if value is None or value == '':
+		return None
+	return float(value)
+
+def login(module, http, url, login_method, login_data, login_retries, login_interval):
 	i = login_retries
 	last_exception = None
 
 	while i > 0:
-		h = httplib2.Http()
-		
 		try:
 			headers = dict()
 			body = dict()
@@ -71,7 +181,7 @@ def login(module, url, login_method, login_data, login_retries, login_interval):
 				if login_data:
 					body = login_data
 
-			response, content = h.request(
+			response, content = http.request(
 				url,
 				login_method,
 				headers = headers,
@@ -86,20 +196,22 @@ def login(module, url, login_method, login_data, login_retries, login_interval):
 		except FailedLoginException as e:
 			last_exception = e
 			break
+		except DeadlineExceededException:
+			raise
 		except Exception as e:
 			last_exception = e
-			time.sleep(login_interval)
+			time.sleep(http.bounded(float(login_interval), url))
 			i -= 1
 
 	module.fail_json(msg = 'Failed login: ' + url + '\n' + traceback.format_exc())
 
-def invoke_url(module, url, cookie):
-	h = httplib2.Http()
-	
+def invoke_url(module, http, url, cookie):
 	try:
-		response, content = h.request(url, 'POST', headers = dict(Cookie = cookie))
+		response, content = http.request(url, 'POST', headers = dict(Cookie = cookie))
 
 		return response, content
+	except DeadlineExceededException:
+		raise
 	except Exception as e:
 		raise Exception('Failed connection: ' + url + '\n' + traceback.format_exc())
 
@@ -1,13 +1,23 @@
 #!/usr/bin/python -tt
 # -*- coding: utf-8 -*-
 
+import errno
+import fcntl
+import glob
 import json
 import hashlib
 import httplib2
 import os
+import Queue
+import re
 import shutil
+import stat
+import subprocess
 import tempfile
+import threading
+import time
 import traceback
+import urlparse
 
 def main():
 	module = AnsibleModule(
@@ -16,43 +26,117 @@ def main():
 			containers = dict(required = True),
 			required_restart = dict(required = False),
 			remove_unused = dict(default = True),
-			plan_file = dict(default = '/tmp/docker_containers_execution_plan')
+			state_dir = dict(default = '/var/lib/docker_containers'),
+			plan_file = dict(required = False),
+			lock_timeout = dict(default = 600),
+			output_tail = dict(default = 4096),
+			keep_logs = dict(default = 50),
+			build_parallelism = dict(default = 4),
+			history_size = dict(default = 20),
+			connect_timeout = dict(default = 10),
+			read_timeout = dict(default = 30),
+			deadline = dict(required = False)
 		),
 		supports_check_mode = True
 	)
 
 	params = module.params
-	plan_file = params['plan_file']
+	state_dir = params['state_dir']
+
+	# cada container e normalizado uma unica vez; o modelo resultante e
+	# compartilhado pelo calculo da hash de configuracao e por todas as
+	# fases do planejamento
+	containers = build_containers(params['containers'])
+	config_hash = build_config_hash(params['state'], containers)
+
+	# sem plan_file explicito, cada configuracao tem o seu plano no state_dir, e
+	# execucoes simultaneas com grupos de containers distintos nao se atrapalham
+	plan_dir = os.path.join(state_dir, 'plans')
+	plan_file = params['plan_file'] or os.path.join(plan_dir, '{0}.json'.format(config_hash))
+
+	prepare_state_dir(module, state_dir)
+	ensure_dir(plan_dir)
+	if os.path.dirname(plan_file):
+		ensure_dir(os.path.dirname(plan_file))
+
+	locks = lock_containers(module, state_dir, containers, float(params['lock_timeout']))
+
+	remove_stale_plans(plan_dir, plan_file, containers)
+
+	http = HttpClient(
+		timeout_value(params['connect_timeout']),
+		timeout_value(params['read_timeout']),
+		timeout_value(params['deadline'])
+	)
+
+	history = ExecutionHistory(os.path.join(state_dir, 'history.jsonl'), int(params['history_size']))
 
 	plan = []
-	if os.path.exists(plan_file):
-		existing_plan = load_plan(plan_file)
-		config_hash = build_config_hash(params)
+	try:
+		if os.path.exists(plan_file):
+			existing_plan = load_plan(plan_file)
 
-		if existing_plan['config_hash'] == config_hash:
-			plan = existing_plan
+			if existing_plan['config_hash'] == config_hash:
+				plan = existing_plan
+			else:
+				plan = build_plan(module, http, history, params, containers, config_hash, plan_dir)
+				dump_plan(plan, plan_file)
 		else:
-			plan = build_plan(module, params)
+			plan = build_plan(module, http, history, params, containers, config_hash, plan_dir)
 			dump_plan(plan, plan_file)
-	else:
-		plan = build_plan(module, params)
-		dump_plan(plan, plan_file)
+	except DeadlineExceededException as e:
+		module.fail_json(
+			msg = str(e),
+			deadline_exceeded = True,
+			elapsed = http.elapsed(),
+			timings = http.timings
+		)
+
+	command_log = CommandLog(
+		module,
+		os.path.join(state_dir, 'logs'),
+		int(params['output_tail']),
+		int(params['keep_logs'])
+	)
+
+	# a previsao e calculada antes da execucao, que consome os comandos do plano
+	prediction = None
+	if module.check_mode:
+		prediction = predict_plan(history, plan['cmds'])
 
-	executed, failed_message = execute_plan(module, plan, plan_file)
+	executed, failed_message, durations = execute_plan(module, command_log, plan, plan_file)
+
+	command_log.close()
+
+	if not module.check_mode and durations:
+		history.append(durations)
+
+	unlock_containers(locks)
 
 	if failed_message is not None:
 		module.fail_json(
 			msg = failed_message,
 			executed = executed,
+			durations = durations,
 			plan = plan
 		)
+	elif prediction is not None:
+		module.exit_json(
+			changed = len(executed) != 0,
+			executed = executed,
+			predicted_duration = prediction['duration'],
+			expected_downtime = prediction['downtime'],
+			unpredicted_steps = prediction['unknown'],
+			fallback_estimated_steps = prediction['fallback']
+		)
 	else:
 		module.exit_json(
 			changed = len(executed) != 0,
-			executed = executed
+			executed = executed,
+			durations = durations
 		)
 
-def run_complex_command(module, cmd):
+def run_complex_command(module, command_log, cmd):
 	if 'type' not in cmd:
 		return 1, None, 'No type defined in complex command'
 
@@ -60,26 +144,29 @@ def run_complex_command(module, cmd):
 	args = cmd['args']
 
 	if cmd_type == 'pull_image':
-		return run_pull_image(module, args)
+		return run_pull_image(module, command_log, args)
 
 	if cmd_type == 'patch_image':
-		return run_patch_image(module, args)
+		return run_patch_image(module, command_log, args)
+
+	if cmd_type == 'patch_images':
+		return run_patch_images(module, command_log, args)
 
 	if cmd_type == 'remove_images':
 		return run_remove_images(module, args)
 
 	if cmd_type == 'stop_container':
-		return run_stop_container(module, args)
+		return run_stop_container(module, command_log, args)
 
 	if cmd_type == 'start_container':
-		return run_start_container(module, args)
+		return run_start_container(module, command_log, args)
 
 	return 1, None, 'Unknown command type: {0}'.format(cmd_type)
 
-def run_pull_image(module, args):
+def run_pull_image(module, command_log, args):
 	image = args['image']
 
-	rc, out, err = module.run_command(['docker', 'pull', image])
+	rc, out, err = command_log.run(['docker', 'pull', image], 'pull', image)
 
 	inspect_rc, _, _ = docker_inspect(module, "{{.Id}}", image)
 
@@ -88,32 +175,45 @@ def run_pull_image(module, args):
 
 	return rc, out, err
 
-def run_start_container(module, args):
+def run_start_container(module, command_log, args):
 	cmd = args['cmd']
 
 	# make sure there's not container with its name
-	rc, out, err = run_stop_container(module, args)
+	rc, out, err = run_stop_container(module, command_log, args)
 
 	if rc != 0:
 		return rc, out, err
 
-	return module.run_command(cmd)
+	return command_log.run(cmd, 'run', args['container_name'])
 
-def run_stop_container(module, args):
+def run_stop_container(module, command_log, args):
 	container_name = args['container_name']
 	status, _, _ = inspect_container_state(module, container_name)
 
 	stop_cmds = build_stop_container_cmds(container_name, status)
 
 	for stop_cmd in stop_cmds:
-		rc, out, err = run_command(module, stop_cmd)
+		rc, out, err = run_command(module, command_log, stop_cmd)
 
 		if rc != 0:
 			return rc, out, err
 
 	return 0, None, None
 
-def run_patch_image(module, args):
+def run_patch_image(module, command_log, args):
+	rc, out, err, temp_dir = prepare_patch_build(module, args)
+
+	if rc != 0:
+		return rc, out, err
+
+	try:
+		return run_patch_build(command_log, args, temp_dir)
+	finally:
+		shutil.rmtree(temp_dir)
+
+# monta o diretorio de build (Dockerfile e arquivos dos patches); usa o
+# module.run_command, e por isso deve ser executado na thread principal
+def prepare_patch_build(module, args):
 	#   args = {
 	#     image: localhost:5000/vedocs-elo:latest,
 	#     patches: [
@@ -124,16 +224,15 @@ def run_patch_image(module, args):
 	#   }
 	image = args['image']
 	patches = args['patches']
-	result_image = args['result_image']
 	temp_dir = tempfile.mkdtemp(prefix = 'tmp-docker-build-')
 
 	dockerfile_path = os.path.join(temp_dir, 'Dockerfile')
-	with open(dockerfile_path, 'w') as dockerfile:
-		dockerfile.write('FROM {0}\n'.format(image))
+	with open(dockerfile_path, 'wb') as dockerfile:
+		dockerfile.write(to_bytes(u'FROM {0}\n'.format(image)))
 
 		for patch in patches:
 			if 'run' in patch:
-				dockerfile.write('RUN {0}\n'.format(patch['run']))
+				dockerfile.write(to_bytes(u'RUN {0}\n'.format(patch['run'])))
 			elif 'add' in patch:
 				head, tail = os.path.split(patch['add']['host'])
 
@@ -143,15 +242,89 @@ def run_patch_image(module, args):
 				# manter os metadados e permitir a utilizacao dos caches do docker
 				rc, out, err = module.run_command(['cp', '-rp', patch['add']['host'], temp_dir])
 				if rc != 0:
-					return rc, out, err
+					shutil.rmtree(temp_dir)
+					return rc, out, err, None
+
+				dockerfile.write(to_bytes(u'ADD {0} {1}\n'.format(tail, patch['add']['image'])))
+
+	return 0, None, None, temp_dir
+
+def run_patch_build(command_log, args, temp_dir):
+	result_image = args['result_image']
+
+	return command_log.run(
+		['docker', 'build', '-t={0}'.format(result_image), temp_dir],
+		'build',
+		result_image
+	)
+
+# executa os builds distintos de patches em paralelo, limitados a parallelism
+# builds simultaneos; a saida (out) e a lista com a duracao de cada build. A
+# preparacao dos diretorios de build e serial, e apenas os processos docker
+# build rodam nas threads
+def run_patch_images(module, command_log, args):
+	completed = args.get('completed', [])
+	builds = [build for build in args['builds'] if build['result_image'] not in completed]
+	parallelism = max(1, int(args.get('parallelism', 1)))
 
-				dockerfile.write('ADD {0} {1}\n'.format(tail, patch['add']['image']))
+	results = []
+	prepared = []
+
+	for build in builds:
+		started = time.time()
+		try:
+			rc, out, err, temp_dir = prepare_patch_build(module, build)
+		except Exception as e:
+			rc, out, err, temp_dir = 1, None, traceback.format_exc(), None
+
+		if rc != 0:
+			results.append((build, rc, err, time.time() - started))
+		else:
+			prepared.append((build, temp_dir, time.time() - started))
+
+	queue = Queue.Queue()
+	for item in prepared:
+		queue.put(item)
+
+	def worker():
+		while True:
+			try:
+				build, temp_dir, elapsed = queue.get_nowait()
+			except Queue.Empty:
+				return
+
+			started = time.time()
+			try:
+				rc, out, err = run_patch_build(command_log, build, temp_dir)
+			except Exception as e:
+				rc, out, err = 1, None, traceback.format_exc()
+
+			results.append((build, rc, err, elapsed + time.time() - started))
+
+	threads = [threading.Thread(target = worker) for i in range(min(parallelism, len(prepared)))]
 	try:
-		return module.run_command(
-			['docker', 'build', '-t={0}'.format(result_image), temp_dir]
-		)
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
 	finally:
-		shutil.rmtree(temp_dir)
+		for build, temp_dir, elapsed in prepared:
+			shutil.rmtree(temp_dir, ignore_errors = True)
+
+	durations = [
+		dict(result_image = build['result_image'], rc = rc, elapsed = round(elapsed, 3))
+		for build, rc, err, elapsed in results
+	]
+
+	# os builds concluidos nao sao refeitos caso o plano seja retomado
+	args['completed'] = completed + [build['result_image'] for build, rc, err, elapsed in results if rc == 0]
+
+	failed = [(build, rc, err) for build, rc, err, elapsed in results if rc != 0]
+	if failed:
+		failed_message = u'\n'.join([u'{0}: {1}'.format(build['result_image'], to_text(err)) for build, rc, err in failed])
+		return failed[0][1], durations, failed_message
+
+	return 0, durations, None
 
 def run_remove_images(module, args):
 	#   args = dict(
@@ -161,6 +334,11 @@ def run_remove_images(module, args):
 	candidates_for_removal = args['candidates_for_removal']
 	used_image_names = args['used_image_names']
 
+	# imagens de planos pendentes de outras execucoes (possivelmente simultaneas)
+	# tambem estao em uso, mesmo que seus containers ainda nao tenham sido iniciados
+	if 'plan_dir' in args:
+		used_image_names = used_image_names + get_pending_image_names(args['plan_dir'])
+
 	used_image_ids = []
 	for used_image_name in used_image_names:
 		rc, out, err = docker_inspect(module, "{{.Id}}", used_image_name)
@@ -180,19 +358,138 @@ def run_remove_images(module, args):
 
 	return 0, None, None
 
-def run_command(module, cmd):
+def run_command(module, command_log, cmd):
 	rc, out, err = 0, None, None
 
 	if not module.check_mode:
 		if isinstance(cmd, basestring) or isinstance(cmd, list):
 			rc, out, err = module.run_command(cmd)
 		elif isinstance(cmd, dict):
-			rc, out, err = run_complex_command(module, cmd)
+			rc, out, err = run_complex_command(module, command_log, cmd)
 
 	return rc, out, err
 
-def execute_plan(module, plan, plan_file):
+# a saida de docker pull/build/run pode chegar a megabytes; em vez de mante-la
+# em memoria (e no resultado do modulo), ela e gravada em um arquivo de log por
+# comando e somente o final dela e devolvido. Cada execucao do modulo grava seus
+# logs em um diretorio proprio, travado (flock) enquanto a execucao dura, e so
+# diretorios de execucoes ja encerradas sao removidos
+class CommandLog(object):
+	def __init__(self, module, log_dir, tail_size, keep_logs):
+		self.module = module
+		self.log_dir = log_dir
+		self.tail_size = tail_size
+		self.keep_logs = keep_logs
+		self.run_dir = None
+		self.run_lock = None
+		self.lock = threading.Lock()
+
+	def run(self, cmd, kind, name):
+		run_dir = self.get_run_dir()
+
+		fd, log_path = tempfile.mkstemp(
+			prefix = '{0}-{1}-'.format(kind, re.sub(r'[^\w.-]', '_', name)),
+			suffix = '.log',
+			dir = run_dir
+		)
+
+		with os.fdopen(fd, 'w+b') as log_file:
+			log_file.write(to_bytes(u'$ {0}\n'.format(u' '.join([to_text(arg) for arg in cmd]))))
+			log_file.flush()
+
+			try:
+				rc = subprocess.Popen(
+					self.build_args(cmd),
+					stdout = log_file,
+					stderr = subprocess.STDOUT,
+					close_fds = True,
+					env = self.build_env()
+				).wait()
+			except OSError as e:
+				log_file.write(to_bytes(u'{0}\n'.format(to_text(e))))
+				rc = 127
+
+			# o final e lido do proprio arquivo aberto, sem reabri-lo pelo caminho
+			log_file.seek(0, os.SEEK_END)
+			log_file.seek(max(0, log_file.tell() - self.tail_size))
+			tail = log_file.read().decode('utf-8', 'replace')
+
+		if rc != 0:
+			return rc, tail, u'{0}\n[full output: {1}]'.format(tail, to_text(log_path))
+
+		return rc, tail, u''
+
+	# mesmo tratamento que module.run_command da aos argumentos em lista
+	def build_args(self, cmd):
+		return [to_bytes(os.path.expanduser(os.path.expandvars(arg))) for arg in cmd if arg is not None]
+
+	# o ambiente e montado para o subprocesso, sem alterar o os.environ, ja que
+	# os builds sao executados em paralelo
+	def build_env(self):
+		env = os.environ.copy()
+		env.update(getattr(self.module, 'run_command_environ_update', None) or dict())
+		return env
+
+	def get_run_dir(self):
+		with self.lock:
+			if self.run_dir is None:
+				ensure_dir(self.log_dir)
+
+				now = time.time()
+				run_dir = tempfile.mkdtemp(
+					prefix = '{0}{1:06d}-'.format(time.strftime('%Y%m%d%H%M%S', time.localtime(now)), int(now % 1 * 1000000)),
+					dir = self.log_dir
+				)
+				self.run_lock = open(os.path.join(run_dir, '.lock'), 'w')
+				fcntl.flock(self.run_lock, fcntl.LOCK_EX)
+				self.run_dir = run_dir
+
+				self.prune()
+
+			return self.run_dir
+
+	# os nomes comecam pelo horario, entao a ordem alfabetica e a cronologica;
+	# diretorios ainda travados pertencem a execucoes em andamento e sao mantidos
+	def prune(self):
+		run_dirs = [path for path in sorted(glob.glob(os.path.join(self.log_dir, '*'))) if os.path.isdir(path)]
+
+		for run_dir in run_dirs[:max(0, len(run_dirs) - self.keep_logs)]:
+			if run_dir == self.run_dir:
+				continue
+
+			try:
+				# sem .lock, o diretorio acabou de ser criado por outra execucao
+				with open(os.path.join(run_dir, '.lock'), 'r') as lock:
+					fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+					shutil.rmtree(run_dir)
+			except (IOError, OSError):
+				pass
+
+	def close(self):
+		if self.run_lock is not None:
+			fcntl.flock(self.run_lock, fcntl.LOCK_UN)
+			self.run_lock.close()
+			self.run_lock = None
+
+def to_text(value):
+	if isinstance(value, unicode):
+		return value
+	if isinstance(value, str):
+		return value.decode('utf-8', 'replace')
+
+	try:
+		return unicode(value)
+	except UnicodeError:
+		return str(value).decode('utf-8', 'replace')
+
+def to_bytes(value):
+	if isinstance(value, unicode):
+		return value.encode('utf-8')
+	return value
+
+def execute_plan(module, command_log, plan, plan_file):
 	executed = []
+	durations = []
 	failed_message = None
 
 	cmds = plan['cmds']
@@ -200,50 +497,111 @@ def execute_plan(module, plan, plan_file):
 	while cmds:
 		cmd = cmds[0]
 
-		rc, out, err = run_command(module, cmd)
+		started = time.time()
+		rc, out, err = run_command(module, command_log, cmd)
+
+		duration = dict(type = None, rc = rc, elapsed = round(time.time() - started, 3))
+		if isinstance(cmd, dict):
+			duration['type'] = cmd.get('type')
+			duration['kind'], duration['key'] = get_step_key(cmd)
+			if cmd.get('type') == 'patch_images':
+				duration['builds'] = out
+		durations.append(duration)
 
 		if rc == 0:
 			cmds.pop(0)
 			executed.append(cmd)
 			dump_plan(plan, plan_file)
 		else:
+			# comandos compostos podem ter registrado progresso parcial nos args
+			dump_plan(plan, plan_file)
 			failed_message = err
 			break
 
 	if not cmds:
 		os.remove(plan_file)
 		
-	return executed, failed_message
+	return executed, failed_message, durations
 
 def load_plan(plan_file):
 	with open(plan_file, 'r') as plan_file:
 		return json.load(plan_file)
 
+# o plano e gravado em um arquivo temporario e renomeado, para que execucoes
+# simultaneas nunca leiam um plano gravado pela metade
 def dump_plan(plan, plan_file):
-	with open(plan_file, 'w') as plan_file:
-		json.dump(plan, plan_file, indent=4, separators=(',', ': '))
+	fd, tmp_plan_file = tempfile.mkstemp(
+		prefix = '{0}.'.format(os.path.basename(plan_file)),
+		suffix = '.tmp',
+		dir = os.path.dirname(plan_file) or '.'
+	)
 
-def build_plan(module, params):
+	with os.fdopen(fd, 'w') as f:
+		json.dump(plan, f, indent=4, separators=(',', ': '))
+
+	os.rename(tmp_plan_file, plan_file)
+
+def list_plans(plan_dir):
+	plans = []
+
+	for plan_file in glob.glob(os.path.join(plan_dir, '*.json')):
+		try:
+			plans.append((plan_file, load_plan(plan_file)))
+		except (IOError, OSError, ValueError):
+			# plano removido ou concluido enquanto era listado
+			pass
+
+	return plans
+
+# como os locks de todos os containers deste plano ja foram obtidos, qualquer
+# outro plano que envolva algum deles foi interrompido e nao sera retomado;
+# somente o plano desta configuracao (que pode ser retomado) e mantido
+def remove_stale_plans(plan_dir, plan_file, containers):
+	names = set([container.name for container in containers])
+
+	for other_plan_file, other_plan in list_plans(plan_dir):
+		if other_plan_file == plan_file:
+			continue
+		if names.intersection(other_plan.get('containers', [])):
+			os.remove(other_plan_file)
+
+def get_pending_image_names(plan_dir):
+	image_names = []
+
+	for _, plan in list_plans(plan_dir):
+		for cmd in plan['cmds']:
+			if not isinstance(cmd, dict):
+				continue
+
+			args = cmd.get('args', dict())
+
+			if cmd.get('type') == 'pull_image':
+				image_names.append(args['image'])
+			elif cmd.get('type') == 'patch_image':
+				image_names.append(args['result_image'])
+			elif cmd.get('type') == 'patch_images':
+				image_names += [build['result_image'] for build in args['builds']]
+			elif cmd.get('type') == 'start_container' and 'image' in args:
+				image_names.append(args['image'])
+
+	return image_names
+
+def build_plan(module, http, history, params, containers, config_hash, plan_dir):
 	state = params['state']
-	containers = params['containers']
 	required_restart = params['required_restart']
 	remove_unused = params['remove_unused']
 
-	config_hash = build_config_hash(params)
-
-	dict_containers = build_dict_containers(containers)
-
 	candidates_for_removal = get_candidates_for_removal(module)
 
-	decide_containers_to_update(module, containers, dict_containers, required_restart, state)
+	decide_containers_to_update(module, http, containers, required_restart, state)
 	
-	stop_cmds = plan_stop_containers(containers, dict_containers)
+	stop_cmds = plan_stop_containers(containers)
 
-	prepare_cmds = plan_prepare_images(containers, dict_containers, state)
+	prepare_cmds = plan_prepare_images(containers, state, int(params['build_parallelism']), history)
 
-	start_cmds, used_image_names = plan_start_containers(containers, dict_containers, state)
+	start_cmds, used_image_names = plan_start_containers(containers, state)
 
-	rmi_cmds = plan_remove_images(candidates_for_removal, used_image_names)
+	rmi_cmds = plan_remove_images(candidates_for_removal, used_image_names, plan_dir)
 
 	cmds = []
 
@@ -258,28 +616,29 @@ def build_plan(module, params):
 
 	return dict(
 		config_hash = config_hash,
+		containers = [container.name for container in containers],
 		cmds = cmds
 	)
 
-def build_config_hash(params):
-	return json_hash(dict(
-		state = params['state'],
-		containers = [ normalize_container(c) for c in params['containers'] ]
+# equivalente a json_hash(dict(state = state, containers = [...])), mas reaproveita
+# o json canonico ja calculado de cada container; as chaves seguem a ordem
+# alfabetica de json.dumps(sort_keys=True) para manter a mesma hash
+def build_config_hash(state, containers):
+	return md5hash('{{"containers":[{0}],"state":{1}}}'.format(
+		','.join([container.config_json for container in containers]),
+		canonical_json(state)
 	))
 
-def decide_containers_to_update(module, containers, dict_containers, required_restart, state):
-	inspect_containers_state(module, containers, dict_containers)
+def decide_containers_to_update(module, http, containers, required_restart, state):
+	inspect_containers_state(module, http, containers)
 	for container in containers:
-		container_name = container['name']
-		dict_container = dict_containers[container_name]
-		
-		if should_update(dict_container, required_restart, state):
-			mark_to_update(dict_container)
+		if should_update(container, required_restart, state):
+			mark_to_update(container)
 
-def mark_to_update(dict_container):
-	dict_container['must_be_updated'] = True
+def mark_to_update(container):
+	container.must_be_updated = True
 	
-	for dependent in dict_container['required_by']:
+	for dependent in container.required_by:
 		mark_to_update(dependent)
 
 def boolean_value(value):
@@ -289,102 +648,102 @@ def boolean_value(value):
 		return value.lower() in ['true', '1', 't', 'y', 'yes']
 	raise Exception('Failed to parse boolean value from ' + value)
 
-def should_update(dict_container, required_restart, state):
+def should_update(container, required_restart, state):
 	if state == 'present' or state == 'prepared':
-		if required_restart is not None and dict_container['name'] in required_restart and boolean_value(required_restart[dict_container['name']]):
+		if required_restart is not None and container.name in required_restart and boolean_value(required_restart[container.name]):
 			return True
-		if dict_container['status'] == '' or dict_container['status'] == 'stopped':
+		if container.status == '' or container.status == 'stopped':
 			return True
-		if dict_container['current_commit'] != dict_container['latest_commit']:
+		if container.current_commit != container.latest_commit:
 			return True
-		if dict_container['current_config_hash'] != dict_container['latest_config_hash']:
+		if container.current_config_hash != container.latest_config_hash:
 			return True
 	else:
-		if dict_container['status'] != '':
+		if container.status != '':
 			return True
 	
 	return False
 
-def inspect_containers_state(module, containers, dict_containers):
+def inspect_containers_state(module, http, containers):
 	for container in containers:
-		container_name = container['name']
-		dict_container = dict_containers[container_name]
-		
-		status, current_commit, current_config_hash = inspect_container_state(module, container['name'])
+		status, current_commit, current_config_hash = inspect_container_state(module, container.name)
 		
-		dict_container['status'] = status
-		dict_container['current_commit'] = current_commit
-		dict_container['current_config_hash'] = current_config_hash
+		container.status = status
+		container.current_commit = current_commit
+		container.current_config_hash = current_config_hash
 		
 		try:
-			latest_commit = get_latest_commit(container, dict_container['image'])
+			latest_commit = get_latest_commit(module, http, container)
+		except DeadlineExceededException:
+			raise
 		except Exception as e:
-			latest_commit = docker_inspect_label(module, 'commitId', dict_container['image'])
+			latest_commit = docker_inspect_label(module, 'commitId', container.image)
 		
-		dict_container['latest_commit'] = latest_commit
+		container.latest_commit = latest_commit
 
-def plan_prepare_images(containers, dict_containers, state):
+# containers que compartilham a mesma imagem (e os mesmos patches) geram um
+# unico pull e um unico build; os builds distintos sao executados em paralelo,
+# e os mais demorados segundo o historico sao iniciados primeiro (os pulls, que
+# sao seriais, mantem a ordem dos containers)
+def plan_prepare_images(containers, state, build_parallelism, history):
 	cmds = []
+	builds = []
+	pulled_images = set()
+	built_images = set()
 	
 	if state == 'present' or state == 'prepared':
 		for container in containers:
-			container_name = container['name']
-			dict_container = dict_containers[container_name]
-			
-			if dict_container['must_be_updated']:
-				cmds.append(dict(
-					type = 'pull_image',
-					comment = 'Tarefa para garantir a existencia da imagem',
-					args = dict(
-						image = dict_container['image']
-					)
-				))
-				if 'patches' in dict_container['container']:
+			if container.must_be_updated:
+				if container.image not in pulled_images:
+					pulled_images.add(container.image)
 					cmds.append(dict(
-						type = 'patch_image',
-						comment = 'Tarefa para executar build de patches nas imagens docker',
+						type = 'pull_image',
+						comment = 'Tarefa para garantir a existencia da imagem',
 						args = dict(
-							image = dict_container['image'],
-							patches = dict_container['container']['patches'],
-							result_image = get_patched_image_name(dict_container)
+							image = container.image
 						)
 					))
+				if container.has_patches() and container.patched_image_name() not in built_images:
+					built_images.add(container.patched_image_name())
+					builds.append(dict(
+						image = container.image,
+						patches = container.spec['patches'],
+						result_image = container.patched_image_name()
+					))
+
+	builds.sort(key = lambda build: history.estimate('build', build['result_image']) or 0, reverse = True)
+
+	if builds:
+		cmds.append(dict(
+			type = 'patch_images',
+			comment = 'Tarefa para executar, em paralelo, os builds de patches nas imagens docker',
+			args = dict(
+				builds = builds,
+				parallelism = build_parallelism
+			)
+		))
+
 	return cmds
 
-def plan_start_containers(containers, dict_containers, state):
+def plan_start_containers(containers, state):
 	cmds = []
 	used_image_names = []
 	
 	if state == 'present':
 		for container in containers:
-			container_name = container['name']
-			dict_container = dict_containers[container_name]
-
-			if dict_container['must_be_updated']:
-				cmd, used_image_name = plan_start_container(dict_container)
+			if container.must_be_updated:
+				cmd, used_image_name = plan_start_container(container)
 				cmds.append(cmd)
 				used_image_names.append(used_image_name)
 	
 	return cmds, used_image_names
 
-# a imagem com patch sera montada sem endereco do registro, com o nome original,
-# e a tag sera a tag original + a hash dos patches; caso algum arquivo do patch
-# seja diferente, o build do proprio docker devera provocar a renomeacao da imagem 
-# nova para uma tag previamente existente
-def get_patched_image_name(dict_container):
-	container = dict_container['container']
-	tag = '{0}_{1}'.format(container['tag'], json_hash(container['patches']))
-	return '{0}:{1}'.format(container['image'], tag)
-
-def plan_stop_containers(containers, dict_containers):
+def plan_stop_containers(containers):
 	cmds = []
 	
 	for container in reversed(containers):
-		container_name = container['name']
-		dict_container = dict_containers[container_name]
-
-		if dict_container['must_be_updated']:
-			cmds += plan_stop_container(container_name)
+		if container.must_be_updated:
+			cmds += plan_stop_container(container.name)
 
 	return cmds
 
@@ -426,15 +785,15 @@ def inspect_container_state(module, container_name):
 	
 	return status, current_commit, current_config_hash
 
-def get_latest_commit(container, image):
-	if 'registry' in container:
-		h = httplib2.Http()
+def get_latest_commit(module, http, container):
+	spec = container.spec
 
-		tag = container['tag'] if 'tag' in container else 'latest'
-		url = "http://{0}/v2/{1}/manifests/{2}".format(container['registry'], container['image'], tag)
+	if 'registry' in spec:
+		tag = spec['tag'] if 'tag' in spec else 'latest'
+		url = "http://{0}/v2/{1}/manifests/{2}".format(spec['registry'], spec['image'], tag)
 
 		try:
-			headers, content = h.request(url, "GET")
+			headers, content = http.request(url, "GET")
 			manifest = json.loads(content)
 			data = json.loads(manifest['history'][0]['v1Compatibility'])
 		
@@ -445,10 +804,99 @@ def get_latest_commit(container, image):
 			if labels_key in config and commit_id_key in config[labels_key]:
 				return config[labels_key][commit_id_key]
 			return ''
+		except DeadlineExceededException:
+			raise
 		except Exception as e:
 			raise Exception('Erro tentando acessar ' + url + '\n' + traceback.format_exc())
 
-	return docker_inspect_label(module, 'commitId', image)
+	return docker_inspect_label(module, 'commitId', container.image)
+
+class DeadlineExceededException(Exception):
+	def __init__(self, url, deadline, elapsed):
+		self.url = url
+		self.deadline = deadline
+		self.elapsed = elapsed
+	def __str__(self):
+		return 'Deadline of {0}s exceeded after {1:.3f}s: {2}'.format(self.deadline, self.elapsed, self.url)
+
+# todas as chamadas http de uma execucao do modulo passam por este cliente, que
+# aplica os timeouts de conexao e de leitura de cada requisicao e limita o tempo
+# total gasto pelo conjunto delas ao deadline configurado
+class HttpClient(object):
+	def __init__(self, connect_timeout, read_timeout, deadline):
+		self.connect_timeout = connect_timeout
+		self.read_timeout = read_timeout
+		self.deadline = deadline
+		self.started = time.time()
+		self.timings = []
+
+	def elapsed(self):
+		return time.time() - self.started
+
+	def remaining(self, url):
+		if self.deadline is None:
+			return None
+
+		remaining = self.deadline - self.elapsed()
+		if remaining <= 0:
+			raise DeadlineExceededException(url, self.deadline, self.elapsed())
+
+		return remaining
+
+	def bounded(self, timeout, url):
+		remaining = self.remaining(url)
+
+		if remaining is None:
+			return timeout
+		if timeout is None:
+			return remaining
+		return min(timeout, remaining)
+
+	def request(self, url, method, **kwargs):
+		connect_timeout = self.bounded(self.connect_timeout, url)
+		read_timeout = self.bounded(self.read_timeout, url)
+
+		h = httplib2.Http(timeout = connect_timeout)
+		timing = dict(url = url, method = method)
+		started = time.time()
+
+		try:
+			response, content = h.request(
+				url,
+				method,
+				connection_type = build_connection_type(url, read_timeout),
+				**kwargs
+			)
+			timing['status'] = response['status']
+			return response, content
+		except Exception as e:
+			timing['error'] = str(e)
+			# um timeout provocado pelo esgotamento do deadline e reportado como tal
+			self.remaining(url)
+			raise
+		finally:
+			timing['elapsed'] = time.time() - started
+			self.timings.append(timing)
+
+def build_connection_type(url, read_timeout):
+	if urlparse.urlparse(url).scheme == 'https':
+		base = httplib2.HTTPSConnectionWithTimeout
+	else:
+		base = httplib2.HTTPConnectionWithTimeout
+
+	# o httplib2 usa o mesmo timeout para conexao e leitura; apos conectar,
+	# o timeout do socket e trocado pelo timeout de leitura
+	class ReadTimeoutConnection(base):
+		def connect(self):
+			base.connect(self)
+			self.sock.settimeout(read_timeout)
+
+	return ReadTimeoutConnection
+
+def timeout_value(value):
+	if value is None or value == '':
+		return None
+	return float(value)
 
 def get_candidates_for_removal(module):
 	image_ids = get_image_ids(module)
@@ -474,7 +922,7 @@ def get_used_image_ids(module):
 
 	return used_image_ids
 
-def plan_remove_images(candidates_for_removal, used_image_names):
+def plan_remove_images(candidates_for_removal, used_image_names, plan_dir):
 	cmds = []
 
 	cmds.append(dict(
@@ -482,54 +930,92 @@ def plan_remove_images(candidates_for_removal, used_image_names):
 		comment = 'Tarefa para remover as imagens que nao serao mais utilizadas',
 		args = dict(
 			candidates_for_removal = candidates_for_removal,
-			used_image_names = used_image_names
+			used_image_names = used_image_names,
+			plan_dir = plan_dir
 		)
 	))
 
 	return cmds
 
-def build_dict_containers(containers):
-	dict_containers = dict()
-	
-	for container in containers:
-		n_container = normalize_container(container)
-		
-		if 'registry' in container:
-			if 'tag' in container:
-				image = '{0}/{1}:{2}'.format(container['registry'], container['image'], container['tag'])
-			else:
-				image = '{0}/{1}'.format(container['registry'], container['image'])
-		else:
-			if 'tag' in container:
-				image = '{1}:{2}'.format(container['image'], container['tag'])
-			else:
-				image = container['image']
-
-		dict_container = dict(
-			name = n_container['name'],
-			image = image,
-			container = n_container,
-			required_by = [],
-			latest_config_hash = json_hash(n_container),
-			must_be_updated = False
-		)
-		
-		dict_containers[container['name']] = dict_container
-	
-	for container in containers:
-		dict_container = dict_containers[container['name']]
+# modelo canonico de um container: a configuracao e normalizada uma unica vez
+# na construcao, e o json canonico, as hashes e os nomes de imagem derivados
+# dela ficam guardados para todas as fases do planejamento; o nome da imagem
+# com patches so e calculado (e guardado) quando um build ou start o usa
+class Container(object):
+	__slots__ = (
+		'name',
+		'spec',
+		'image',
+		'config_json',
+		'latest_config_hash',
+		'patched_image',
+		'required_by',
+		'must_be_updated',
+		'status',
+		'current_commit',
+		'current_config_hash',
+		'latest_commit'
+	)
+
+	def __init__(self, container):
+		self.spec = normalize_container(container)
+		self.name = self.spec['name']
+		self.image = build_image_name(self.spec)
+		self.config_json = canonical_json(self.spec)
+		# mesma hash gravada no label configHash dos containers existentes
+		self.latest_config_hash = md5hash(self.config_json)
+		self.patched_image = None
+
+		self.required_by = []
+		self.must_be_updated = False
+		self.status = ''
+		self.current_commit = ''
+		self.current_config_hash = ''
+		self.latest_commit = ''
+
+	def has_patches(self):
+		return 'patches' in self.spec
+
+	def patched_image_name(self):
+		if self.patched_image is None:
+			self.patched_image = get_patched_image_name(self.spec)
+		return self.patched_image
+
+	def run_image(self):
+		if self.has_patches():
+			return self.patched_image_name()
+		return self.image
+
+def build_containers(containers):
+	models = [Container(container) for container in containers]
+	models_by_name = dict([(model.name, model) for model in models])
 	
-		if 'volumes_from' in container:
-			volumes_from = container['volumes_from']
-			for vol_provider in volumes_from:
-				dict_containers[vol_provider]['required_by'].append(dict_container)
+	for model in models:
+		for vol_provider in model.spec['volumes_from']:
+			models_by_name[vol_provider].required_by.append(model)
 	
-		if 'links' in container:
-			links = container['links']
-			for link in links:
-				dict_containers[link['name']]['required_by'].append(dict_container)
+		for link in model.spec['links']:
+			models_by_name[link['name']].required_by.append(model)
 	
-	return dict_containers
+	return models
+
+def build_image_name(container):
+	if 'registry' in container:
+		if 'tag' in container:
+			return '{0}/{1}:{2}'.format(container['registry'], container['image'], container['tag'])
+		return '{0}/{1}'.format(container['registry'], container['image'])
+
+	if 'tag' in container:
+		return '{0}:{1}'.format(container['image'], container['tag'])
+	return container['image']
+
+# a imagem com patch sera montada sem endereco do registro, com o nome original,
+# e a tag sera a tag original + a hash dos patches; caso algum arquivo do patch
+# seja diferente, o build do proprio docker devera provocar a renomeacao da imagem 
+# nova para uma tag previamente existente
+def get_patched_image_name(container):
+	tag = '{0}_{1}'.format(container['tag'], json_hash(container['patches']))
+	return '{0}:{1}'.format(container['image'], tag)
 
 def normalize_container(container):
 	attr_as_is = ['name', 'daemon', 'registry', 'image', 'tag', 'environment_variables', 'patches', 'args', 'extra_options']
@@ -569,12 +1055,12 @@ def normalize_list_of_dicts(n_container, container, name, keys, sort_key):
 	
 	n_container[name] = n_list
 
-def plan_start_container(dict_container):
-	container = dict_container['container']
+def plan_start_container(model):
+	container = model.spec
 	
 	cmd = ['docker', 'run', '--name', container['name']]
 	
-	cmd += ['--label', '{0}={1}'.format('configHash', dict_container['latest_config_hash'])]
+	cmd += ['--label', '{0}={1}'.format('configHash', model.latest_config_hash)]
 	
 	if 'daemon' in container and container['daemon']:
 		cmd += ['-d', '--restart', 'always']
@@ -620,10 +1106,7 @@ def plan_start_container(dict_container):
 		elif isinstance(extra_options, list):
 			cmd += extra_options
 
-	if 'patches' in container:
-		image = get_patched_image_name(dict_container)
-	else:
-		image = dict_container['image']
+	image = model.run_image()
 
 	cmd += [image]
 	
@@ -639,12 +1122,240 @@ def plan_start_container(dict_container):
 		comment = 'Tarefa para iniciar o container; ela pode provocar tambem a remocao de algum container de mesmo nome preexistente',
 		args = dict(
 			cmd = cmd,
-			container_name = container['name']
+			container_name = container['name'],
+			image = image
 		)
 	)
 
 	return complex_command, image
 
+# tipo e chave sob os quais a duracao de um comando e guardada no historico
+def get_step_key(cmd):
+	cmd_type = cmd.get('type')
+	args = cmd.get('args', dict())
+
+	if cmd_type == 'pull_image':
+		return 'pull', args['image']
+	if cmd_type == 'patch_image':
+		return 'build', args['result_image']
+	if cmd_type == 'stop_container':
+		return 'stop', args['container_name']
+	if cmd_type == 'start_container':
+		return 'start', args['container_name']
+	if cmd_type == 'remove_images':
+		return 'remove_images', ''
+
+	return None, None
+
+# historico compacto das execucoes: uma linha json por execucao com a duracao
+# de cada stop/pull/build/start, mantendo apenas as ultimas size execucoes;
+# com size 0 o historico fica desabilitado (nada e lido nem gravado)
+class ExecutionHistory(object):
+	def __init__(self, path, size):
+		self.path = path
+		self.size = size
+		self.samples = dict()
+
+		for run in self.load():
+			for kind, steps in run['steps'].items():
+				for key, elapsed in steps.items():
+					self.samples.setdefault(kind, dict()).setdefault(key, []).append(elapsed)
+
+	def load(self):
+		runs = []
+
+		if self.size <= 0 or not os.path.exists(self.path):
+			return runs
+
+		with open(self.path, 'r') as f:
+			for line in f.readlines()[-self.size:]:
+				try:
+					runs.append(json.loads(line))
+				except ValueError:
+					# linha truncada por uma execucao interrompida
+					pass
+
+		return runs
+
+	def has_samples(self, kind, key):
+		return key in self.samples.get(kind, dict())
+
+	# media das ultimas duracoes do passo; sem historico do passo, usa a media
+	# dos passos do mesmo tipo, e sem nenhum historico do tipo, devolve None
+	def estimate(self, kind, key):
+		steps = self.samples.get(kind, dict())
+
+		if key in steps:
+			values = steps[key]
+		else:
+			values = [value for values in steps.values() for value in values]
+
+		if not values:
+			return None
+
+		return float(sum(values)) / len(values)
+
+	def append(self, durations):
+		if self.size <= 0:
+			return
+
+		steps = dict()
+
+		for duration in durations:
+			if duration['rc'] != 0:
+				continue
+
+			if duration['type'] == 'patch_images':
+				for build in duration['builds'] or []:
+					if build['rc'] == 0:
+						steps.setdefault('build', dict())[build['result_image']] = build['elapsed']
+			elif duration.get('kind') is not None:
+				steps.setdefault(duration['kind'], dict())[duration['key']] = duration['elapsed']
+
+		if not steps:
+			return
+
+		line = json.dumps(dict(time = int(time.time()), steps = steps), sort_keys = True, separators = (',', ':')) + '\n'
+
+		ensure_dir(os.path.dirname(self.path))
+
+		# execucoes simultaneas gravam sob lock; o arquivo e reduzido as ultimas
+		# size execucoes quando passa do dobro desse tamanho
+		with open(self.path, 'a+') as f:
+			fcntl.flock(f, fcntl.LOCK_EX)
+			try:
+				f.seek(0)
+				lines = f.readlines()
+
+				if len(lines) + 1 > 2 * self.size:
+					lines = (lines + [line])[-self.size:]
+					f.seek(0)
+					f.truncate()
+					f.writelines(lines)
+				else:
+					f.write(line)
+			finally:
+				fcntl.flock(f, fcntl.LOCK_UN)
+
+# previsao da duracao do plano e do tempo que cada container fica fora do ar,
+# do inicio da sua parada ate o fim do seu start; passos sem nenhum historico
+# do tipo entram como 0 em unknown, e passos estimados pela media do tipo
+# (imagens ou containers novos) sao listados em fallback
+def predict_plan(history, cmds):
+	elapsed = 0.0
+	stopped_at = dict()
+	downtime = dict()
+	unknown = []
+	fallback = []
+
+	def estimate(kind, key):
+		value = history.estimate(kind, key)
+
+		if value is None:
+			unknown.append(dict(kind = kind, key = key))
+			return 0
+		if not history.has_samples(kind, key):
+			fallback.append(dict(kind = kind, key = key))
+
+		return value
+
+	for cmd in cmds:
+		if not isinstance(cmd, dict):
+			continue
+
+		if cmd.get('type') == 'patch_images':
+			completed = cmd['args'].get('completed', [])
+			estimates = [
+				estimate('build', build['result_image'])
+				for build in cmd['args']['builds'] if build['result_image'] not in completed
+			]
+			duration = predict_parallel(estimates, int(cmd['args'].get('parallelism', 1)))
+		else:
+			kind, key = get_step_key(cmd)
+			duration = estimate(kind, key)
+
+		if cmd.get('type') in ('stop_container', 'start_container'):
+			name = cmd['args']['container_name']
+			stopped_at.setdefault(name, elapsed)
+
+		elapsed += duration
+
+		if cmd.get('type') == 'start_container':
+			downtime[name] = round(elapsed - stopped_at[name], 3)
+
+	return dict(
+		duration = round(elapsed, 3),
+		downtime = downtime,
+		unknown = unknown,
+		fallback = fallback
+	)
+
+# duracao de builds paralelos, atribuindo cada um (do mais longo para o mais
+# curto, como no plano) ao worker que fica livre primeiro
+def predict_parallel(estimates, parallelism):
+	workers = [0.0] * max(1, min(parallelism, len(estimates)))
+
+	for estimate in sorted(estimates, reverse = True):
+		workers.sort()
+		workers[0] += estimate
+
+	return max(workers)
+
+def ensure_dir(path):
+	try:
+		os.makedirs(path, 0o700)
+	except OSError as e:
+		if e.errno != errno.EEXIST:
+			raise
+
+# o state_dir guarda planos, locks, logs e o historico e e usado pelo root; um
+# diretorio preexistente de outro dono (ou um link simbolico) poderia ter sido
+# preparado por outro usuario para redirecionar essas gravacoes
+def prepare_state_dir(module, state_dir):
+	ensure_dir(state_dir)
+
+	st = os.lstat(state_dir)
+	if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.geteuid():
+		module.fail_json(msg = 'Refusing to use state_dir {0}: it must be a directory owned by uid {1}'.format(state_dir, os.geteuid()))
+
+# locks consultivos (flock) por container: execucoes simultaneas so esperam
+# umas pelas outras quando seus grupos de containers se sobrepoem; os locks sao
+# obtidos em ordem alfabetica para evitar deadlocks. Os locks cobrem todos os
+# containers configurados, e nao so os que o plano altera: como o plano so e
+# conhecido depois de inspecionar os containers, dois grupos que declaram o
+# mesmo container compartilhado sao serializados mesmo que ele nao mude
+def lock_containers(module, state_dir, containers, lock_timeout):
+	lock_dir = os.path.join(state_dir, 'locks')
+	ensure_dir(lock_dir)
+
+	locks = []
+	deadline = time.time() + lock_timeout
+
+	for name in sorted(set([container.name for container in containers])):
+		lock = open(os.path.join(lock_dir, '{0}.lock'.format(name)), 'a')
+
+		while True:
+			try:
+				fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+				break
+			except IOError as e:
+				if e.errno not in (errno.EAGAIN, errno.EACCES):
+					raise
+				if time.time() >= deadline:
+					lock.close()
+					unlock_containers(locks)
+					module.fail_json(msg = 'Timeout waiting for lock of container {0}'.format(name))
+				time.sleep(0.5)
+
+		locks.append(lock)
+
+	return locks
+
+def unlock_containers(locks):
+	for lock in reversed(locks):
+		fcntl.flock(lock, fcntl.LOCK_UN)
+		lock.close()
+
 def build_stop_container_cmds(container_name, status):
 	cmds = []
 
@@ -673,7 +1384,10 @@ def docker_inspect(module, path, name):
 	return rc, out, err
 
 def json_hash(obj):
-	return md5hash(json.dumps(obj, sort_keys=True, separators=(',',':')))
+	return md5hash(canonical_json(obj))
+
+def canonical_json(obj):
+	return json.dumps(obj, sort_keys=True, separators=(',',':'))
 
 def md5hash(string):
     m = hashlib.md5()
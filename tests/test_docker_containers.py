@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+
+import fcntl
+import os
+import shutil
+import socket
+import sys
+import subprocess
+import tempfile
+import threading
+import unittest
+
+MODULE_PATH = os.path.join(os.path.dirname(__file__), '..', 'roles', 'docker', 'library', 'docker_containers.py')
+
+# o modulo termina importando o ansible e chamando main(); so as definicoes sao carregadas
+def load_module():
+	with open(MODULE_PATH) as f:
+		source = f.read().rsplit('from ansible.module_utils.basic import *', 1)[0]
+
+	namespace = dict(__name__ = 'docker_containers')
+	exec(compile(source, MODULE_PATH, 'exec'), namespace)
+	return namespace
+
+docker_containers = load_module()
+
+class FakeModule(object):
+	check_mode = False
+	run_command_environ_update = dict()
+
+	def __init__(self):
+		self.threads = []
+
+	def run_command(self, cmd):
+		self.threads.append(threading.current_thread())
+		process = subprocess.Popen(cmd, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+		out, err = process.communicate()
+		return process.returncode, out, err
+
+# com DOCKER_BARRIER definido, cada build espera (ate 10s) que outro build
+# tambem tenha comecado, e registra em DOCKER_BARRIER.alone se isso nao ocorreu
+FAKE_DOCKER = '''#!/bin/sh
+if [ -n "$DOCKER_BARRIER" ]; then
+	touch "$DOCKER_BARRIER/$$"
+	i=0
+	while [ $(ls "$DOCKER_BARRIER" | wc -l) -lt 2 ] && [ $i -lt 100 ]; do sleep 0.1; i=$((i+1)); done
+	[ $(ls "$DOCKER_BARRIER" | wc -l) -ge 2 ] || echo "$$" >> "$DOCKER_BARRIER.alone"
+fi
+case "$*" in *quebrada*) echo "falhou"; exit 1;; esac
+cat "$3/Dockerfile"
+'''
+
+# docker inspect falha como se nao houvesse container nem imagem local
+class NoDockerModule(FakeModule):
+	def run_command(self, cmd):
+		return 1, '', 'No such object'
+
+class RegistryTimeoutTest(unittest.TestCase):
+	def setUp(self):
+		# aceita conexoes (pelo backlog do kernel) mas nunca responde
+		self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.server.bind(('127.0.0.1', 0))
+		self.server.listen(16)
+		registry = '127.0.0.1:{0}'.format(self.server.getsockname()[1])
+		self.container = docker_containers['build_containers']([dict(name = 'a', image = 'app', registry = registry)])[0]
+
+	def tearDown(self):
+		self.server.close()
+
+	def test_read_timeout_is_reported_as_registry_error(self):
+		http = docker_containers['HttpClient'](5, 0.2, None)
+
+		self.assertRaises(Exception, docker_containers['get_latest_commit'], NoDockerModule(), http, self.container)
+		self.assertTrue('error' in http.timings[0])
+
+	def test_deadline_is_not_hidden_by_local_fallback(self):
+		http = docker_containers['HttpClient'](5, 5, 0.3)
+
+		self.assertRaises(
+			docker_containers['DeadlineExceededException'],
+			docker_containers['inspect_containers_state'], NoDockerModule(), http, [self.container]
+		)
+
+class ContainerModelTest(unittest.TestCase):
+	# valores calculados com json_hash(normalize_container(...)) antes da introducao
+	# do modelo; mudar estas hashes muda o label configHash e reinicia os containers
+	WEB = dict(
+		name = 'web',
+		image = 'app',
+		tag = '1.0',
+		registry = 'localhost:5000',
+		daemon = True,
+		environment_variables = {u'MENSAGEM': u'ação'},
+		ports = [dict(container = 80, host = 8080), dict(container = 443, host = 8443, ip = '0.0.0.0')],
+		volumes = [dict(container = '/data', host = '/srv/dados', mode = 'ro')],
+		links = [dict(name = 'db', alias = 'banco')],
+		volumes_from = ['db'],
+		patches = [dict(run = u'echo olá')],
+		args = ['--porta', '80']
+	)
+	DB = dict(name = 'db', image = 'postgres')
+
+	def test_config_hashes_match_existing_labels(self):
+		db, web = docker_containers['build_containers']([self.DB, self.WEB])
+
+		self.assertEqual(web.latest_config_hash, '3b853758e9465969560ee41f37a3b1cc')
+		self.assertEqual(db.latest_config_hash, 'd487401cc0cb5ab73efbfd353a031040')
+		self.assertEqual(web.latest_config_hash, docker_containers['json_hash'](docker_containers['normalize_container'](self.WEB)))
+		self.assertEqual(docker_containers['build_config_hash']('present', [db, web]), 'd77345d31e4aa670a7d66c82dc191cd0')
+
+	def test_patched_container_without_tag_is_only_named_when_used(self):
+		containers = docker_containers['build_containers']([dict(name = 'a', image = 'app', patches = [dict(run = 'true')])])
+		history = docker_containers['ExecutionHistory']('/nonexistent/history.jsonl', 5)
+
+		containers[0].must_be_updated = True
+		self.assertEqual(docker_containers['plan_prepare_images'](containers, 'absent', 4, history), [])
+		self.assertEqual(len(docker_containers['plan_stop_containers'](containers)), 1)
+		self.assertEqual(docker_containers['plan_start_containers'](containers, 'absent'), ([], []))
+
+class CommandLogTest(unittest.TestCase):
+	def setUp(self):
+		self.log_dir = tempfile.mkdtemp()
+		self.command_log = docker_containers['CommandLog'](FakeModule(), self.log_dir, 4096, 5)
+
+	def tearDown(self):
+		self.command_log.close()
+		shutil.rmtree(self.log_dir)
+
+	def test_non_ascii_args(self):
+		rc, out, err = self.command_log.run(['echo', u'VAR=não é'], 'run', u'container-é')
+
+		self.assertEqual(rc, 0)
+		self.assertTrue(u'VAR=não é' in out)
+
+	def test_non_ascii_failing_output(self):
+		rc, out, err = self.command_log.run(['sh', '-c', u'echo "não encontrada"; exit 1'], 'pull', u'imagem')
+
+		self.assertEqual(rc, 1)
+		self.assertTrue(u'não encontrada' in err)
+		self.assertTrue(u'[full output: ' in err)
+
+	def test_tail_is_bounded(self):
+		self.command_log.tail_size = 16
+		rc, out, err = self.command_log.run(['sh', '-c', 'seq 1 100000'], 'build', 'x')
+
+		self.assertEqual(rc, 0)
+		self.assertTrue(len(out) <= 16)
+		self.assertTrue(out.endswith(u'100000\n'))
+
+	def test_expands_user_and_vars_like_run_command(self):
+		os.environ['DOCKER_CONTAINERS_TEST'] = 'valor'
+		try:
+			rc, out, err = self.command_log.run(['echo', '$DOCKER_CONTAINERS_TEST', '~/data'], 'run', 'x')
+		finally:
+			del os.environ['DOCKER_CONTAINERS_TEST']
+
+		self.assertTrue(u'valor' in out)
+		self.assertTrue(os.path.expanduser('~/data') in out)
+
+	def test_prune_keeps_logs_of_running_executions(self):
+		self.command_log.run(['true'], 'pull', 'x')
+
+		other = docker_containers['CommandLog'](FakeModule(), self.log_dir, 4096, 1)
+		other.run(['true'], 'pull', 'y')
+		self.assertTrue(os.path.isdir(self.command_log.run_dir))
+
+		self.command_log.close()
+		newest = docker_containers['CommandLog'](FakeModule(), self.log_dir, 4096, 1)
+		newest.run(['true'], 'pull', 'z')
+		other.close()
+		newest.close()
+
+		self.assertFalse(os.path.isdir(self.command_log.run_dir))
+
+class PatchImagesTest(unittest.TestCase):
+	def setUp(self):
+		self.work_dir = tempfile.mkdtemp()
+		self.path = os.environ['PATH']
+
+		bin_dir = os.path.join(self.work_dir, 'bin')
+		os.mkdir(bin_dir)
+		with open(os.path.join(bin_dir, 'docker'), 'w') as f:
+			f.write(FAKE_DOCKER)
+		os.chmod(os.path.join(bin_dir, 'docker'), 0o755)
+		os.environ['PATH'] = bin_dir + os.pathsep + self.path
+
+		with open(os.path.join(self.work_dir, 'config'), 'w') as f:
+			f.write('x')
+
+		self.module = FakeModule()
+		self.command_log = docker_containers['CommandLog'](self.module, os.path.join(self.work_dir, 'logs'), 4096, 5)
+
+	def tearDown(self):
+		os.environ['PATH'] = self.path
+		self.command_log.close()
+		shutil.rmtree(self.work_dir)
+
+	def build_containers(self, specs):
+		containers = docker_containers['build_containers'](specs)
+		for container in containers:
+			container.must_be_updated = True
+		return containers
+
+	def test_builds_are_deduplicated_and_run_in_parallel(self):
+		patches = [dict(run = u'echo ação'), dict(add = dict(host = os.path.join(self.work_dir, 'config'), image = '/etc/config'))]
+		containers = self.build_containers(
+			[dict(name = 'app{0}'.format(i), image = 'app', tag = '1', patches = patches) for i in range(3)] +
+			[dict(name = 'other', image = 'other', tag = '1', patches = patches)]
+		)
+		history = docker_containers['ExecutionHistory'](os.path.join(self.work_dir, 'history.jsonl'), 5)
+
+		cmds = docker_containers['plan_prepare_images'](containers, 'present', 4, history)
+		args = cmds[-1]['args']
+		result_images = [build['result_image'] for build in args['builds']]
+		self.assertEqual(len(result_images), 2)
+
+		barrier = os.path.join(self.work_dir, 'barrier')
+		os.mkdir(barrier)
+		os.environ['DOCKER_BARRIER'] = barrier
+		try:
+			rc, out, err = docker_containers['run_patch_images'](self.module, self.command_log, args)
+		finally:
+			del os.environ['DOCKER_BARRIER']
+
+		self.assertEqual(rc, 0)
+		# os dois builds estiveram em execucao ao mesmo tempo
+		self.assertEqual(len(os.listdir(barrier)), 2)
+		self.assertFalse(os.path.exists(barrier + '.alone'))
+		self.assertEqual(len(out), 2)
+		self.assertEqual(sorted(args['completed']), sorted(result_images))
+		# a preparacao (cp) acontece somente na thread principal
+		self.assertEqual(set(self.module.threads), set([threading.current_thread()]))
+
+	def test_failed_build_is_reported_and_retried_alone(self):
+		containers = self.build_containers([
+			dict(name = 'ok', image = 'ok', tag = '1', patches = [dict(run = 'true')]),
+			dict(name = 'bad', image = 'quebrada', tag = '1', patches = [dict(run = 'true')])
+		])
+		history = docker_containers['ExecutionHistory'](os.path.join(self.work_dir, 'history.jsonl'), 5)
+		args = docker_containers['plan_prepare_images'](containers, 'present', 4, history)[-1]['args']
+
+		rc, out, err = docker_containers['run_patch_images'](self.module, self.command_log, args)
+
+		self.assertEqual(rc, 1)
+		self.assertTrue(u'falhou' in err)
+		self.assertEqual(args['completed'], [containers[0].patched_image_name()])
+		self.assertEqual(len(args['builds']), 2)
+
+class ModuleFailed(Exception):
+	pass
+
+class StateDirTest(unittest.TestCase):
+	def setUp(self):
+		self.work_dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.work_dir)
+
+	def fail_json(self, **kwargs):
+		raise ModuleFailed(kwargs['msg'])
+
+	def test_creates_private_state_dir(self):
+		state_dir = os.path.join(self.work_dir, 'state')
+		module = FakeModule()
+		module.fail_json = self.fail_json
+
+		docker_containers['prepare_state_dir'](module, state_dir)
+
+		self.assertEqual(os.stat(state_dir).st_mode & 0o077, 0)
+
+	def test_refuses_symlinked_state_dir(self):
+		state_dir = os.path.join(self.work_dir, 'state')
+		os.symlink(self.work_dir, state_dir)
+		module = FakeModule()
+		module.fail_json = self.fail_json
+
+		self.assertRaises(ModuleFailed, docker_containers['prepare_state_dir'], module, state_dir)
+
+	def test_overlapping_group_waits_for_lock_and_times_out(self):
+		module = FakeModule()
+		module.fail_json = self.fail_json
+		docker_containers['ensure_dir'](os.path.join(self.work_dir, 'locks'))
+
+		# lock mantido por outro descritor, como o de outra execucao do modulo
+		with open(os.path.join(self.work_dir, 'locks', 'shared.lock'), 'a') as other:
+			fcntl.flock(other, fcntl.LOCK_EX)
+
+			overlapping = docker_containers['build_containers']([dict(name = 'app', image = 'x'), dict(name = 'shared', image = 'y')])
+			self.assertRaises(ModuleFailed, docker_containers['lock_containers'], module, self.work_dir, overlapping, 0.3)
+
+			disjoint = docker_containers['build_containers']([dict(name = 'app', image = 'x'), dict(name = 'other', image = 'y')])
+			locks = docker_containers['lock_containers'](module, self.work_dir, disjoint, 0.3)
+			self.assertEqual(len(locks), 2)
+			docker_containers['unlock_containers'](locks)
+
+	def test_removes_stale_plans_touching_locked_containers(self):
+		containers = docker_containers['build_containers']([dict(name = 'a', image = 'x')])
+		plan_file = os.path.join(self.work_dir, 'current.json')
+
+		for name, plan_containers in [('current', ['a']), ('stale', ['a', 'b']), ('other', ['c'])]:
+			docker_containers['dump_plan'](
+				dict(config_hash = name, containers = plan_containers, cmds = []),
+				os.path.join(self.work_dir, '{0}.json'.format(name))
+			)
+
+		docker_containers['remove_stale_plans'](self.work_dir, plan_file, containers)
+
+		self.assertEqual(sorted(os.listdir(self.work_dir)), ['current.json', 'other.json'])
+
+def duration(cmd_type, kind, key, elapsed, rc = 0):
+	return dict(type = cmd_type, kind = kind, key = key, elapsed = elapsed, rc = rc)
+
+def step(cmd_type, **args):
+	return dict(type = cmd_type, args = args)
+
+class ExecutionHistoryTest(unittest.TestCase):
+	def setUp(self):
+		self.work_dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.work_dir, 'history.jsonl')
+
+	def tearDown(self):
+		shutil.rmtree(self.work_dir)
+
+	def history(self, size = 10):
+		return docker_containers['ExecutionHistory'](self.path, size)
+
+	def lines(self):
+		with open(self.path) as f:
+			return f.readlines()
+
+	def test_estimate_uses_key_mean_and_falls_back_to_kind_mean(self):
+		history = self.history()
+		history.append([duration('pull_image', 'pull', 'a', 2.0), duration('pull_image', 'pull', 'b', 10.0)])
+		history.append([duration('pull_image', 'pull', 'a', 4.0)])
+
+		history = self.history()
+		self.assertEqual(history.estimate('pull', 'a'), 3.0)
+		self.assertEqual(history.estimate('pull', 'new'), 16.0 / 3)
+		self.assertTrue(history.has_samples('pull', 'a'))
+		self.assertFalse(history.has_samples('pull', 'new'))
+		self.assertEqual(history.estimate('start', 'a'), None)
+
+	def test_trims_to_history_size(self):
+		history = self.history(2)
+		for i in range(5):
+			history.append([duration('pull_image', 'pull', 'a', float(i))])
+
+		self.assertTrue(len(self.lines()) <= 4)
+		self.assertEqual(self.history(2).estimate('pull', 'a'), 3.5)
+
+	def test_zero_size_disables_history(self):
+		history = self.history(0)
+		for i in range(5):
+			history.append([duration('pull_image', 'pull', 'a', 1.0)])
+
+		self.assertFalse(os.path.exists(self.path))
+		self.assertEqual(history.estimate('pull', 'a'), None)
+
+	def test_append_skips_failed_steps_and_builds(self):
+		self.history().append([
+			duration('pull_image', 'pull', 'a', 1.0),
+			duration('start_container', 'start', 'a', 5.0, rc = 1),
+			dict(duration('patch_images', None, None, 3.0), builds = [
+				dict(result_image = 'ok', rc = 0, elapsed = 3.0),
+				dict(result_image = 'bad', rc = 1, elapsed = 9.0)
+			]),
+			dict(duration('patch_images', None, None, 9.0, rc = 1), builds = [
+				dict(result_image = 'other', rc = 0, elapsed = 9.0)
+			])
+		])
+
+		history = self.history()
+		self.assertEqual(history.estimate('start', 'a'), None)
+		self.assertTrue(history.has_samples('build', 'ok'))
+		self.assertFalse(history.has_samples('build', 'bad'))
+		self.assertFalse(history.has_samples('build', 'other'))
+
+	def test_predicts_downtime_from_stop_to_end_of_start(self):
+		history = self.history()
+		history.append([
+			duration('pull_image', 'pull', 'img', 10.0),
+			duration('stop_container', 'stop', 'a', 2.0),
+			duration('stop_container', 'stop', 'b', 3.0),
+			duration('remove_images', 'remove_images', '', 1.0),
+			duration('start_container', 'start', 'a', 4.0),
+			duration('start_container', 'start', 'b', 5.0)
+		])
+
+		prediction = docker_containers['predict_plan'](self.history(), [
+			step('pull_image', image = 'img'),
+			step('stop_container', container_name = 'b'),
+			step('stop_container', container_name = 'a'),
+			step('remove_images'),
+			step('start_container', container_name = 'a'),
+			step('start_container', container_name = 'b')
+		])
+
+		self.assertEqual(prediction['duration'], 25.0)
+		# o pull nao conta como tempo fora do ar; b para em 10 e volta em 25, a para em 13 e volta em 20
+		self.assertEqual(prediction['downtime'], dict(a = 7.0, b = 15.0))
+		self.assertEqual(prediction['unknown'], [])
+		self.assertEqual(prediction['fallback'], [])
+
+	def test_reports_unknown_and_fallback_steps(self):
+		history = self.history()
+		history.append([duration('pull_image', 'pull', 'img', 10.0)])
+
+		prediction = docker_containers['predict_plan'](self.history(), [
+			step('pull_image', image = 'new'),
+			step('start_container', container_name = 'a')
+		])
+
+		self.assertEqual(prediction['fallback'], [dict(kind = 'pull', key = 'new')])
+		self.assertEqual(prediction['unknown'], [dict(kind = 'start', key = 'a')])
+		self.assertEqual(prediction['duration'], 10.0)
+
+	def test_parallel_builds_are_assigned_longest_first(self):
+		predict_parallel = docker_containers['predict_parallel']
+
+		# 5 e 4 em workers distintos, 3 vai para o worker com 4, e 2 para o com 5
+		self.assertEqual(predict_parallel([2, 3, 4, 5], 2), 7)
+		self.assertEqual(predict_parallel([2, 3, 4, 5], 1), 14)
+		self.assertEqual(predict_parallel([2, 3, 4, 5], 8), 5)
+		self.assertEqual(predict_parallel([], 4), 0)
+
+if __name__ == '__main__':
+	unittest.main()
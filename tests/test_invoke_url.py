@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+import os
+import socket
+import time
+import unittest
+
+MODULE_PATH = os.path.join(os.path.dirname(__file__), '..', 'library', 'invoke_url.py')
+
+# o modulo termina importando o ansible e chamando main(); so as definicoes sao carregadas
+def load_module():
+	with open(MODULE_PATH) as f:
+		source = f.read().rsplit('from ansible.module_utils.basic import *', 1)[0]
+
+	namespace = dict(__name__ = 'invoke_url')
+	exec(compile(source, MODULE_PATH, 'exec'), namespace)
+	return namespace
+
+invoke_url = load_module()
+
+# servidor que aceita conexoes (pelo backlog do kernel) mas nunca responde
+class SilentServer(object):
+	def __init__(self):
+		self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.socket.bind(('127.0.0.1', 0))
+		self.socket.listen(16)
+		self.url = 'http://127.0.0.1:{0}/'.format(self.socket.getsockname()[1])
+
+	def close(self):
+		self.socket.close()
+
+class RecordingTime(object):
+	def __init__(self):
+		self.sleeps = []
+
+	def time(self):
+		return time.time()
+
+	def sleep(self, seconds):
+		self.sleeps.append(seconds)
+		time.sleep(seconds)
+
+class ModuleFailed(Exception):
+	pass
+
+class FakeModule(object):
+	def fail_json(self, **kwargs):
+		raise ModuleFailed(kwargs['msg'])
+
+class HttpClientTest(unittest.TestCase):
+	def setUp(self):
+		self.server = SilentServer()
+
+	def tearDown(self):
+		self.server.close()
+		invoke_url['time'] = time
+
+	def test_read_timeout(self):
+		http = invoke_url['HttpClient'](5, 0.2, None)
+
+		self.assertRaises(socket.timeout, http.request, self.server.url, 'GET')
+		self.assertEqual(len(http.timings), 1)
+		self.assertTrue('error' in http.timings[0])
+
+	def test_deadline_exceeded_instead_of_socket_timeout(self):
+		http = invoke_url['HttpClient'](5, 5, 0.3)
+
+		self.assertRaises(invoke_url['DeadlineExceededException'], http.request, self.server.url, 'GET')
+
+	def test_login_stops_retrying_at_deadline(self):
+		recording_time = RecordingTime()
+		invoke_url['time'] = recording_time
+		http = invoke_url['HttpClient'](5, 0.2, 0.8)
+
+		self.assertRaises(
+			invoke_url['DeadlineExceededException'],
+			invoke_url['login'], FakeModule(), http, self.server.url, 'POST', None, 100, 10
+		)
+
+		self.assertTrue(len(http.timings) < 100)
+		self.assertTrue(all([seconds <= 0.8 for seconds in recording_time.sleeps]))
+
+if __name__ == '__main__':
+	unittest.main()